@@ -1,9 +1,13 @@
 import pandas as pd
-from openai import OpenAI
+import httpx
+import openpyxl
+from openai import AsyncOpenAI, BadRequestError
 from loguru import logger
-import sys, os, datetime, re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import sys, os, datetime, re, json, asyncio, sqlite3, hashlib, shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tenacity import retry, stop_after_attempt, wait_exponential
+from aiolimiter import AsyncLimiter
 from tqdm import tqdm
 from dotenv import load_dotenv
 
@@ -14,10 +18,15 @@ load_dotenv()
 API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
 # 2025 DeepSeek-V3 官方定价 (人民币)
-PRICE_IN_M = 2.0   # 输入: 2元/百万 tokens
-PRICE_OUT_M = 8.0  # 输出: 8元/百万 tokens
+PRICE_IN_M = 2.0       # 输入(缓存未命中): 2元/百万 tokens
+PRICE_IN_HIT_M = 0.5   # 输入(缓存命中): 0.5元/百万 tokens
+PRICE_OUT_M = 8.0      # 输出: 8元/百万 tokens
 
-MAX_WORKERS = 45   # 性能模式，Tier 1 用户若报错可降至 15
+BATCH_ROWS = 10    # 每个请求打包的行数（系统提示开销被 K 行摊薄）
+ROW_SEP = "\n%%\n" # 多行打包的分隔哨兵
+
+# 源文自带裸 %% 行会让模型看到“多余的分隔符”，整批行数对不齐 => 这类源文单独成批
+_RE_BARE_SEP = re.compile(r"(?m)^\s*%%\s*$")
 
 # Excel 列名（保持中文不变）
 LANGS = [
@@ -44,93 +53,353 @@ LANG_EN = {
     "阿拉伯语": "Arabic",
 }
 
-client = OpenAI(api_key=API_KEY, base_url="https://api.deepseek.com")
+# 反查表：模型返回的英文键 -> Excel 中文列名
+LANG_CN = {en: cn for cn, en in LANG_EN.items()}
+
+# 需要走 API 的语言（英语直接拷贝原文，不进 JSON）
+API_LANGS = [lang for lang in LANGS if lang != "英语"]
+
+# ✅ HTTP/2 长连接：几条 TLS 会话上多路复用全部请求，省掉反复握手（重试交给 tenacity）
+#    注意：显式传 transport 时 httpx 会忽略客户端级 limits，这里让客户端自建传输层
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+    timeout=30,
+)
+
+# ✅ 纯网络 I/O 负载：asyncio 单线程协作调度，不再为每个在途请求付一条 OS 线程
+aclient = AsyncOpenAI(api_key=API_KEY, base_url="https://api.deepseek.com", http_client=http_client)
+
+# ✅ 并发度改由服务端限额驱动：RPM + TPM 令牌桶取代固定 worker 数，
+#    既不撞 429 退避墙，也不把配额闲置在保守的线程数上
+rpm_bucket = AsyncLimiter(4000, 60)        # 请求/分钟
+tpm_bucket = AsyncLimiter(1_500_000, 60)   # tokens/分钟（按估算预扣）
+
+def _est_tokens(payload: str) -> int:
+    # 粗估 ~3 字符/token，再加提示词固定开销
+    return len(payload) // 3 + 50
+
+# ✅ 字节级稳定的系统提示：所有请求共享同一前缀，吃满 DeepSeek 缓存命中折扣
+#    （模块级常量，每次请求复用同一字符串对象，变量部分只出现在 user 消息里）
+_PROMPT_TAIL = (
+    "Return a JSON object {\"rows\": [...]} where \"rows\" has exactly one "
+    "object per source text, in the same order. "
+    f"Each object has exactly these keys: {', '.join(LANG_EN[lang] for lang in API_LANGS)}. "
+    "Each value is the translation of that source text into that language. "
+    "Return ONLY the JSON object, no commentary."
+)
+SYSTEM_PROMPT = (
+    "You are a professional technical translator. "
+    "The user message contains several source texts separated by a line "
+    "containing only %%. " + _PROMPT_TAIL
+)
+# 单条批次专用变体：不提分隔符，源文里的 %% 行就不会被模型当成“多条输入”拆开
+SYSTEM_PROMPT_SINGLE = (
+    "You are a professional technical translator. "
+    "The user message is ONE single source text; treat it verbatim, even if "
+    "it contains %% lines. " + _PROMPT_TAIL
+)
+
+# ✅ 启动时生成一次 JSON Schema：键集合由服务端强约束（漏键 / 造键 / 夹带评论
+#    都发不出来），省掉解析失败重试，也压掉多余的输出 tokens
+RESPONSE_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "translations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "rows": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {LANG_EN[lang]: {"type": "string"} for lang in API_LANGS},
+                        "required": [LANG_EN[lang] for lang in API_LANGS],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["rows"],
+            "additionalProperties": False,
+        },
+    },
+}
+_JSON_OBJECT = {"type": "json_object"}
+
+# 服务端若 4xx 拒绝 json_schema（接口版本不支持），降级为 json_object 并记住
+_schema_supported = True
+
+async def _create_completion(messages):
+    global _schema_supported
+    if _schema_supported:
+        try:
+            return await aclient.chat.completions.create(
+                model="deepseek-chat",
+                messages=messages,
+                response_format=RESPONSE_SCHEMA,
+                timeout=30
+            )
+        except BadRequestError as e:
+            _schema_supported = False
+            logger.opt(lazy=True).error("json_schema rejected, falling back to json_object: {}",
+                                        lambda: str(e))
+    return await aclient.chat.completions.create(
+        model="deepseek-chat",
+        messages=messages,
+        response_format=_JSON_OBJECT,
+        timeout=30
+    )
+
+# ✅ 翻译记忆：按 (sha1(原文), 语言) 持久缓存，重复词条跨行 / 跨次运行零成本复用
+#    asyncio 单线程，一条连接即可，无需加锁
+CACHE_DB = "trans_cache.db"
+cache = sqlite3.connect(CACHE_DB)
+cache.execute("CREATE TABLE IF NOT EXISTS c (hash TEXT, lang TEXT, txt TEXT, PRIMARY KEY(hash, lang))")
+
+def _cache_lookup(h: str):
+    """全部目标语言都命中才算命中，否则整行照常走 API（避免半行拼接）。"""
+    hit = dict(cache.execute("SELECT lang, txt FROM c WHERE hash=?", (h,)).fetchall())
+    if all(lang in hit for lang in API_LANGS):
+        return {lang: hit[lang] for lang in API_LANGS}
+    return None
+
+def _cache_store(h: str, row_trans: dict):
+    cache.executemany(
+        "INSERT OR IGNORE INTO c (hash, lang, txt) VALUES (?, ?, ?)",
+        [(h, lang, txt) for lang, txt in row_trans.items()]
+    )
+    cache.commit()
+
+# ✅ 增量检查点：完成的 (行, 语言, 译文) 批量落 Parquet，中途崩溃后重跑可跳过
+#    已完成的部分，成功出 Excel 后自动清理。
+#    每次刷盘写一个自带 footer 的独立 part 文件（先写临时名再原子改名），
+#    这样任何时刻被杀掉，已落盘的 part 都完整可读 —— 单个 ParquetWriter
+#    不 close 就没有 footer，崩溃后反而什么都恢复不了
+CKPT_SCHEMA = pa.schema([("row", pa.int64()), ("lang", pa.string()), ("txt", pa.string())])
+CKPT_FLUSH_EVERY = 1024   # 攒满多少格刷一个 part
+
+def _ckpt_dir_for(input_file: str) -> str:
+    """检查点目录与输入文件内容绑定：批处理连跑多个文件 / 文件被改过，
+    行号都对不上别人的检查点，不会把 A 文件的译文续跑进 B 文件。"""
+    digest = hashlib.sha1()
+    with open(input_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return f"progress_ckpt_{digest.hexdigest()[:12]}"
+
+def _ckpt_load(ckpt_dir: str) -> dict:
+    """读取上次中断留下的检查点，返回 {(行, 语言): 译文}。"""
+    if not os.path.isdir(ckpt_dir):
+        return {}
+    done = {}
+    for name in sorted(os.listdir(ckpt_dir)):
+        if not name.endswith(".parquet"):
+            continue
+        try:
+            records = pq.read_table(os.path.join(ckpt_dir, name)).to_pylist()
+        except Exception as e:
+            # 单个 part 坏了只丢这一个，其余照常恢复
+            logger.opt(lazy=True).error("Skipping unreadable checkpoint part {}: {}",
+                                        lambda: name, lambda: str(e))
+            continue
+        for rec in records:
+            # 旧检查点可能混有 ERROR，恢复时同样丢弃
+            if rec["txt"] != "ERROR":
+                done[(rec["row"], rec["lang"])] = rec["txt"]
+    return done
+
+def _ckpt_flush(ckpt_dir: str, buf: list):
+    if not buf:
+        return
+    os.makedirs(ckpt_dir, exist_ok=True)
+    seq = sum(1 for n in os.listdir(ckpt_dir) if n.endswith(".parquet"))
+    tmp = os.path.join(ckpt_dir, "_inflight.tmp")
+    pq.write_table(pa.Table.from_pylist(buf, schema=CKPT_SCHEMA), tmp)
+    os.replace(tmp, os.path.join(ckpt_dir, f"part-{seq:05d}.parquet"))
+    buf.clear()
 
 # 日志仅记录错误到文件（每次运行覆盖旧日志，避免历史残留误判）
+# enqueue=True：格式化与落盘移到日志线程，错误风暴时不卡热路径
 logger.remove()
-logger.add("error_log.log", level="ERROR", mode="w")
+logger.add("error_log.log", level="ERROR", mode="w", enqueue=True)
 
 # --- 轻量语言校验（用于“翻成中文”等跑偏） ---
-_RE_HAN = re.compile(r"[\u4e00-\u9fff]")     # 汉字
-_RE_ARABIC = re.compile(r"[\u0600-\u06FF]") # 阿拉伯字符
-_RE_CYR = re.compile(r"[\u0400-\u04FF]")    # 西里尔（俄/乌）
-_RE_KANA = re.compile(r"[\u3040-\u30FF]")   # 日语假名（平/片）
+# 四类脚本合成一个带命名组的交替模式：单次扫描判定出现了哪些文字系统
+_RE_SCRIPTS = re.compile(
+    r"(?P<han>[\u4e00-\u9fff])"    # 汉字
+    r"|(?P<ar>[\u0600-\u06FF])"    # 阿拉伯字符
+    r"|(?P<cyr>[\u0400-\u04FF])"   # 西里尔（俄/乌）
+    r"|(?P<kana>[\u3040-\u30FF])"  # 日语假名（平/片）
+)
+_N_SCRIPTS = 4
+
+def _scripts_in(s: str) -> frozenset:
+    # 纯 ASCII（技术文本常见情形）直接短路，完全不进正则
+    if s.isascii():
+        return frozenset()
+    found = set()
+    for m in _RE_SCRIPTS.finditer(s):
+        found.add(m.lastgroup)
+        if len(found) == _N_SCRIPTS:
+            break
+    return frozenset(found)
+
+# 表驱动规则：语言 -> (禁止出现的脚本, 必须出现的脚本)
+# 日语不设规则（可含汉字 / 也可能纯英文术语，不强杀）
+_LANG_RULES = {
+    "阿拉伯语": (frozenset({"han"}), frozenset({"ar"})),
+    "俄语": (frozenset({"han"}), frozenset({"cyr"})),
+    "乌克兰语": (frozenset({"han"}), frozenset({"cyr"})),
+    "日语": (frozenset(), frozenset()),
+}
+# 其余语言：出现汉字 => 判为跑偏
+_DEFAULT_RULE = (frozenset({"han"}), frozenset())
 
 def _lang_ok(lang_cn: str, out: str) -> bool:
     s = (out or "").strip()
     if not s:
         return True
 
-    # 目标不是日语：出现汉字 => 判为跑偏，触发重试
-    if lang_cn != "日语" and _RE_HAN.search(s):
-        return False
-
-    # 阿拉伯语：必须包含阿拉伯字符（否则大概率跑偏）
-    if lang_cn == "阿拉伯语" and not _RE_ARABIC.search(s):
-        return False
-
-    # 俄语 / 乌克兰语：建议至少包含西里尔（技术文本可能夹英文，但完全没有通常不对）
-    if lang_cn in ("俄语", "乌克兰语") and not _RE_CYR.search(s):
-        return False
-
-    # 日语：不强杀（因为日语可含汉字/也可能纯英文术语）
-    if lang_cn == "日语":
+    forbid, require = _LANG_RULES.get(lang_cn, _DEFAULT_RULE)
+    if not forbid and not require:
         return True
 
-    return True
+    scripts = _scripts_in(s)
+    return not (scripts & forbid) and require <= scripts
 
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
-def call_api(text: str, lang_cn: str):
-    lang_en = LANG_EN.get(lang_cn, lang_cn)
+async def call_api(texts: list):
+    # ✅ K 行 × 14 语言合并为一个请求：系统提示 / HTTP 往返被 K 行摊薄
+    #    只有一条时换不提分隔符的提示词（两个常量前缀都各自吃缓存折扣）
     messages = [
-        {
-            "role": "system",
-            "content": (
-                "You are a professional technical translator. "
-                f"Translate the user's text into {lang_en}. "
-                f"Return ONLY the translation, written in {lang_en}."
-            )
-        },
-        {"role": "user", "content": text}
+        {"role": "system", "content": SYSTEM_PROMPT if len(texts) > 1 else SYSTEM_PROMPT_SINGLE},
+        {"role": "user", "content": ROW_SEP.join(texts)}
     ]
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=messages,
-        timeout=30
-    )
-    out_text = response.choices[0].message.content.strip()
-
-    # 校验失败 => 抛异常触发 tenacity 自动重试（不增加额外 API 调用）
-    if not _lang_ok(lang_cn, out_text):
-        raise ValueError(f"LANG_MISMATCH: expected={lang_en}({lang_cn})")
-
-    return {
-        "text": out_text,
+    # 发送前先从 RPM / TPM 桶里预扣额度（每次重试重新扣，和服务端计数一致）
+    async with rpm_bucket:
+        await tpm_bucket.acquire(min(_est_tokens(messages[1]["content"]), int(tpm_bucket.max_rate)))
+        response = await _create_completion(messages)
+    raw = response.choices[0].message.content
+    rows_out = json.loads(raw).get("rows")
+
+    # 行数没对齐（结构性失败）=> 抛异常触发 tenacity 整批重试
+    if not isinstance(rows_out, list) or len(rows_out) != len(texts):
+        got = len(rows_out) if isinstance(rows_out, list) else "non-list"
+        raise ValueError(f"ROW_COUNT_MISMATCH: expected={len(texts)} got={got}")
+
+    usage = {
         "in": getattr(response.usage, "prompt_tokens", 0) or 0,
+        # DeepSeek 在 usage 里单独暴露缓存命中的输入 tokens（计费更便宜）
+        "in_hit": getattr(response.usage, "prompt_cache_hit_tokens", 0) or 0,
         "out": getattr(response.usage, "completion_tokens", 0) or 0
     }
 
-def do_job(row_idx: int, lang_cn: str, text):
-    if pd.isna(text) or str(text).strip() == "":
-        return row_idx, lang_cn, "", 0, 0
-
-    # ✅ 最小修复：英语列不走 API，直接回填原文（省钱 + 100% 成功率）
-    if lang_cn == "英语":
-        return row_idx, lang_cn, str(text), 0, 0
-
+    # ✅ 键缺失 / 语言跑偏不再整批重试（那会把 14 种已正确的译文重烧一遍），
+    #    而是记下坏键，单独补一枪
+    translations = []
+    bad = {}   # pos -> [lang_cn, ...]
+    for pos, row in enumerate(rows_out):
+        row_trans = {}
+        bad_langs = []
+        for lang_cn in API_LANGS:
+            out_text = str(row.get(LANG_EN[lang_cn], "")).strip()
+            if not out_text or not _lang_ok(lang_cn, out_text):
+                bad_langs.append(lang_cn)
+            else:
+                row_trans[lang_cn] = out_text
+        translations.append(row_trans)
+        if bad_langs:
+            bad[pos] = bad_langs
+
+    if bad:
+        await _reprompt_bad(messages, raw, bad, translations, usage)
+
+    # 补枪后仍坏的键标 ERROR，不再花 tokens
+    for pos, bad_langs in bad.items():
+        for lang_cn in bad_langs:
+            translations[pos].setdefault(lang_cn, "ERROR")
+
+    usage["translations"] = translations
+    return usage
+
+async def _reprompt_bad(messages, raw, bad, translations, usage):
+    """只对坏掉的 (行, 语言) 补一次请求；成功的键原样保留，失败由调用方标 ERROR。"""
+    ask = {str(pos): [LANG_EN[l] for l in bad_langs] for pos, bad_langs in bad.items()}
+    followup = messages + [
+        {"role": "assistant", "content": raw},
+        {"role": "user", "content": (
+            "Some values are not written in their target language. "
+            "Re-translate ONLY the keys listed below, strictly in the target "
+            "language's script (no Chinese characters unless the target is Japanese). "
+            "Return a JSON object {\"rows\": [{\"row\": <0-based index>, <Language>: <translation>, ...}]} "
+            f"covering exactly these row indices and keys: {json.dumps(ask)}"
+        )},
+    ]
     try:
-        res = call_api(str(text), lang_cn)
-        return row_idx, lang_cn, res["text"], res["in"], res["out"]
+        async with rpm_bucket:
+            await tpm_bucket.acquire(min(_est_tokens(followup[-1]["content"]), int(tpm_bucket.max_rate)))
+            # 补枪只要部分键，不能套要求全键的严格 schema => 保持 json_object
+            response = await aclient.chat.completions.create(
+                model="deepseek-chat",
+                messages=followup,
+                response_format=_JSON_OBJECT,
+                timeout=30
+            )
+        usage["in"] += getattr(response.usage, "prompt_tokens", 0) or 0
+        usage["in_hit"] += getattr(response.usage, "prompt_cache_hit_tokens", 0) or 0
+        usage["out"] += getattr(response.usage, "completion_tokens", 0) or 0
+
+        for entry in json.loads(response.choices[0].message.content).get("rows", []):
+            try:
+                pos = int(entry.get("row", -1))
+            except (TypeError, ValueError):
+                continue
+            for lang_cn in bad.get(pos, []):
+                out_text = str(entry.get(LANG_EN[lang_cn], "")).strip()
+                if out_text and _lang_ok(lang_cn, out_text):
+                    translations[pos][lang_cn] = out_text
     except Exception as e:
-        logger.error(f"Error at Row {row_idx} [{lang_cn}]: {e}")
+        # 补枪失败不致命：对应键由调用方标 ERROR（lazy：消息拼接推迟到日志线程）
+        logger.opt(lazy=True).error("Re-prompt failed for {}: {}",
+                                    lambda: json.dumps(ask), lambda: str(e))
+
+async def do_batch(texts: list):
+    """翻译一批去重后的原文，返回 [(原文, {语言: 译文}), ...] 与 token 消耗。"""
+    # 每条先铺默认值；英语列不走 API，直接回填原文（省钱 + 100% 成功率）
+    batch_out = []
+    api_slots = []   # (batch_out 下标, 原文, sha1) —— 缓存命中不进请求
+    for text in texts:
+        batch_out.append((text, {"英语": text}))
+
+        # 缓存命中 => 直接回填，in=out=0
+        h = hashlib.sha1(text.encode()).hexdigest()
+        cached = _cache_lookup(h)
+        if cached is not None:
+            batch_out[-1][1].update(cached)
+        else:
+            api_slots.append((len(batch_out) - 1, text, h))
+
+    if not api_slots:
+        return batch_out, 0, 0, 0
 
-        # ✅ 兜底：如果英语列出现 ERROR（理论上不会走到这里），强制回填原文
-        if lang_cn == "英语":
-            return row_idx, lang_cn, str(text), 0, 0
-
-        return row_idx, lang_cn, "ERROR", 0, 0
-
-def main():
+    try:
+        res = await call_api([t for _, t, _ in api_slots])
+        for (slot, _, h), row_trans in zip(api_slots, res["translations"]):
+            batch_out[slot][1].update(row_trans)
+            # 含 ERROR 的行不进缓存，下次运行重新翻
+            if "ERROR" not in row_trans.values():
+                _cache_store(h, row_trans)
+        return batch_out, res["in"], res["in_hit"], res["out"]
+    except Exception as e:
+        # lazy：f-string 拼接挪出热路径，只有真正写日志时才构造
+        logger.opt(lazy=True).error("Error for texts {}: {}",
+                                    lambda: [t[:40] for _, t, _ in api_slots], lambda: str(e))
+        for slot, _, _ in api_slots:
+            batch_out[slot][1].update({lang: "ERROR" for lang in API_LANGS})
+        return batch_out, 0, 0, 0
+
+async def main_async():
     print(f"\n{'='*50}\n🚀 DeepSeek 工业翻译官 (稳定列顺序 + 语言校验 + 英语直拷贝)\n{'='*50}")
 
     input_file = sys.argv[1] if len(sys.argv) > 1 else "source.xlsx"
@@ -138,56 +407,131 @@ def main():
         print(f"❌ 错误: 找不到文件 '{input_file}'")
         return
 
-    df = pd.read_excel(input_file)
+    # ✅ 流式读取：read_only 模式逐行抽取 Original 列，不把整本工作簿解析成 DataFrame
+    wb = openpyxl.load_workbook(input_file, read_only=True, data_only=True)
+    ws = wb.active
+    rows_iter = ws.iter_rows(values_only=True)
+    header = next(rows_iter, None)
 
-    if "Original" not in df.columns:
+    if header is None or "Original" not in header:
         print("❌ 错误: Excel 必须包含列名 'Original'")
+        wb.close()
         return
 
-    # ✅ 先按固定顺序创建语言列，避免 as_completed 导致列顺序漂移
-    for lang in LANGS:
-        if lang not in df.columns:
-            df[lang] = ""
-
-    total_tasks = len(df) * len(LANGS)
-
-    # 统计数据
-    stats = {"in": 0, "out": 0}
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = []
-        for idx in range(len(df)):
-            source = df.at[idx, "Original"]
-            for lang in LANGS:
-                futures.append(executor.submit(do_job, idx, lang, source))
-
-        with tqdm(total=total_tasks, desc="任务进度", unit="格", colour="#00ff00") as pbar:
-            for f in as_completed(futures):
-                r_idx, lang, res, in_t, out_t = f.result()
-                df.at[r_idx, lang] = res
+    col = header.index("Original")
+    originals = [
+        "" if (col >= len(row) or row[col] is None) else str(row[col])
+        for row in rows_iter
+    ]
+    wb.close()
+
+    # ✅ 源文去重：同一原文只翻一次，结果广播回全部出现的行（空行直接留空）
+    uniq = {}   # 原文 -> [行号, ...]
+    for idx, text in enumerate(originals):
+        if text.strip():
+            uniq.setdefault(text, []).append(idx)
+    # ✅ 最长的先发（LPT 调度）：慢请求先占住并发位，短请求垫后，压掉收尾长尾；
+    #    顺带让每个批次内长度相近，模型输出长度更可预测
+    uniq_texts = sorted(uniq, key=len, reverse=True)
+    print(f"📋 共 {len(originals)} 行，去重后 {len(uniq_texts)} 条待翻译")
+
+    # ✅ 结果先落预分配数组，循环里不碰 DataFrame（单格 df.at 写入有 dtype 升级开销）
+    results = {lang: [""] * len(originals) for lang in LANGS}
+
+    # ✅ 断点续跑：先回灌检查点（目录按输入内容哈希命名），已全部完成的词条不再提交
+    ckpt_dir = _ckpt_dir_for(input_file)
+    done = _ckpt_load(ckpt_dir)
+    if done:
+        print(f"🔁 检查点续跑：已恢复 {len(done)} 格")
+        for (r_idx, lang), txt in done.items():
+            if lang in results and 0 <= r_idx < len(originals):
+                results[lang][r_idx] = txt
+    pending = [
+        text for text in uniq_texts
+        if not all((r, lang) in done for r in uniq[text] for lang in LANGS)
+    ]
+    # 已恢复的数据仍躺在原 part 文件里，不必重写
+    ckpt_buf = []
+
+    # 统计数据（in_hit 为命中提示缓存的输入 tokens，计费打折）
+    stats = {"in": 0, "in_hit": 0, "out": 0}
+
+    # 单线程事件循环：并发度由 RPM/TPM 令牌桶控制，结果回填在主任务上无需加锁
+    # BATCH_ROWS 条 = 一个请求（K 条 × 15 语言合并进同一个 JSON 响应）
+    # 含裸 %% 行的源文单独成批：就算模型数错行，也只废掉这一条而不是整个批次
+    safe = [t for t in pending if not _RE_BARE_SEP.search(t)]
+    risky = [t for t in pending if _RE_BARE_SEP.search(t)]
+    tasks = []
+    for start in range(0, len(safe), BATCH_ROWS):
+        texts = safe[start:start + BATCH_ROWS]
+        tasks.append(asyncio.create_task(do_batch(texts)))
+    for text in risky:
+        tasks.append(asyncio.create_task(do_batch([text])))
+
+    # ✅ 进度条降频：完成数先攒在本地计数器，攒够一批才 update 一次；
+    #    mininterval/smoothing 再压掉高频重绘的终端 I/O 与锁竞争
+    try:
+        with tqdm(total=len(pending), desc="任务进度", unit="条", colour="#00ff00",
+                  mininterval=0.2, maxinterval=1.0, smoothing=0) as pbar:
+            done_acc = 0
+            for coro in asyncio.as_completed(tasks):
+                batch_out, in_t, hit_t, out_t = await coro
+                for text, row_out in batch_out:
+                    for r_idx in uniq[text]:
+                        for lang, res in row_out.items():
+                            results[lang][r_idx] = res
+                            # ERROR 不进检查点（与 sqlite 缓存同策略）：续跑时重试
+                            if res != "ERROR":
+                                ckpt_buf.append({"row": r_idx, "lang": lang, "txt": res})
+                if len(ckpt_buf) >= CKPT_FLUSH_EVERY:
+                    _ckpt_flush(ckpt_dir, ckpt_buf)
                 stats["in"] += in_t
+                stats["in_hit"] += hit_t
                 stats["out"] += out_t
-                pbar.update(1)
-
-    # ✅ 保存前强制重排列顺序：Original + LANGS，其它列保留在最后
-    head = ["Original"] + LANGS
-    tail = [c for c in df.columns if c not in head]
-    df = df[head + tail]
-
-    # 费用结算
-    cost_in = (stats["in"] / 1_000_000) * PRICE_IN_M
+                done_acc += len(batch_out)
+                if done_acc >= 64:
+                    pbar.update(done_acc)
+                    done_acc = 0
+            if done_acc:
+                pbar.update(done_acc)
+    finally:
+        # 崩溃 / Ctrl+C 也把缓冲里已完成的格子刷成完整 part
+        _ckpt_flush(ckpt_dir, ckpt_buf)
+
+    # ✅ DataFrame 只在写结果前构造一次：Original + 固定顺序的语言列
+    df = pd.DataFrame({"Original": originals, **{lang: results[lang] for lang in LANGS}})
+
+    # 费用结算（缓存命中部分按折扣价单算）
+    in_miss = stats["in"] - stats["in_hit"]
+    cost_in = (in_miss / 1_000_000) * PRICE_IN_M + (stats["in_hit"] / 1_000_000) * PRICE_IN_HIT_M
     cost_out = (stats["out"] / 1_000_000) * PRICE_OUT_M
 
     print(f"\n{'💰 账单结算':-^40}")
-    print(f"输入消耗: {stats['in']:>8} tokens (￥{cost_in:.4f})")
+    print(f"输入消耗: {stats['in']:>8} tokens (其中缓存命中 {stats['in_hit']}) (￥{cost_in:.4f})")
     print(f"输出消耗: {stats['out']:>8} tokens (￥{cost_out:.4f})")
     print(f"总计成本: ￥{cost_in + cost_out:.4f}")
     print("-" * 40)
 
     out_name = f"Translated_{datetime.datetime.now().strftime('%m%d_%H%M')}.xlsx"
-    df.to_excel(out_name, index=False)
+    # ✅ xlsxwriter 引擎：比 openpyxl 少一层单元格对象模型，写出快、峰值内存低
+    #    （不能开 constant_memory：to_excel 按列喂数据，行被提前冲掉会静默丢译文）
+    with pd.ExcelWriter(
+        out_name,
+        engine="xlsxwriter",
+        engine_kwargs={"options": {"strings_to_urls": False}}
+    ) as writer:
+        df.to_excel(writer, index=False)
+
+    # Excel 已安全落盘 => 检查点完成使命，删掉避免下次误续跑
+    shutil.rmtree(ckpt_dir, ignore_errors=True)
     print(f"✨ 处理完成！结果已存至: {out_name}\n")
 
+async def _run():
+    try:
+        await main_async()
+    finally:
+        await http_client.aclose()
+
 if __name__ == "__main__":
-    main()
+    asyncio.run(_run())
 